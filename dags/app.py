@@ -12,33 +12,43 @@
 #     - people_voted
 #
 # What this DAG does:
-#   1) Creates a target table (goodreads_books) if it does not exist.
-#   2) Scrapes up to MAX_PAGES of the list (polite rate-limit + retries).
-#   3) Inserts the parsed rows into Postgres in a single task.
+#   In a single task:
+#   1) Scrapes up to MAX_PAGES of the list (polite rate-limit + retries).
+#   2) Creates the target table (goodreads_books) if it does not exist and bulk-loads the rows
+#      in one transaction, upserting on (title, author).
 #
 # Configuration you may want to change:
 #   - POSTGRES_CONN_ID: Airflow connection id for your Postgres (must resolve to postgres:5432 in Docker).
 #   - NUM_BOOKS: total number of rows to collect (ceil ~ 100 per page).
 #   - MAX_PAGES: how many pages to crawl (the list supports ?page=N).
 #   - REQUEST_DELAY_SECS: polite delay between requests to avoid throttling.
+#   - FETCH_CONCURRENCY: pages fetched in parallel; request starts stay spaced so the
+#     overall rate is roughly FETCH_CONCURRENCY times the sequential one.
 #
 # Notes:
 #   - Parsing is defensive: Goodreads markup can change. We target selectors that are stable as of now.
-#   - If scraping yields zero rows (blocked / markup change), a small mock fallback is used so the
-#     pipeline remains testable during development. Remove the fallback if you prefer a hard failure.
+#   - If scraping yields zero rows (blocked / markup change), the task fails. With USE_MOCK_FALLBACK
+#     enabled (development only) it logs a small mock fallback instead and succeeds without loading
+#     anything: goodreads_books persists across runs, so fake rows must never be written to it.
 # =============================================================================
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import csv
+import io
+import threading
 import time
 import random
 import re
 import requests
-import pandas as pd
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from requests.utils import get_encoding_from_headers
+from urllib3.util.retry import Retry
+import lxml.etree
+import lxml.html
 
 from airflow import DAG
 from airflow.providers.standard.operators.python import PythonOperator
-from airflow.providers.common.sql.operators.sql import SQLExecuteQueryOperator
 from airflow.providers.postgres.hooks.postgres import PostgresHook
 
 # ------------------------------ CONFIG ---------------------------------------
@@ -48,6 +58,32 @@ LIST_URL           = "https://www.goodreads.com/list/show/1.Best_Books_Ever"
 NUM_BOOKS          = 1_000                    # Target total rows (approx 100 rows/page)
 MAX_PAGES          = 100                      # Maximum pages to fetch
 REQUEST_DELAY_SECS = (0.8, 2.0)               # Randomized polite delay range per page
+FETCH_CONCURRENCY  = 4                        # Pages fetched in parallel (shares the delay budget)
+USE_MOCK_FALLBACK  = False                    # Dev only: on an empty scrape, log mock rows instead of failing
+
+BOOK_COLUMNS = ("title", "author", "avg_rating", "num_ratings", "score", "people_voted")
+
+_RETRY_AFTER_CAP_SECS = 10  # longest a page fetch will sleep on a server's Retry-After
+
+class _CappedRetry(Retry):
+    """Retry that honours Retry-After, capped so a throttled page can't stall the whole task."""
+
+    def get_retry_after(self, response) -> float | None:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, _RETRY_AFTER_CAP_SECS)
+
+# Transport-level retries for transient throttling / server errors, honouring Retry-After.
+# Worst case per page is total * _RETRY_AFTER_CAP_SECS; after that the fetch raises, the crawl
+# stops, and the rows collected so far are still loaded.
+_HTTP_RETRY = _CappedRetry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods={"GET"},
+    respect_retry_after_header=True,
+)
+# The connection pre-warm is best-effort: one attempt, never waiting on Retry-After
+_PREWARM_RETRY = Retry(total=0)
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
@@ -57,15 +93,41 @@ HEADERS = {
 
 # --------------------------- PARSING HELPERS ---------------------------------
 
-_num_re   = re.compile(r"[\d,]+")
+_PG_INT_MAX = 2_147_483_647  # upper bound of Postgres INTEGER columns
+
+_COMMA_TBL = str.maketrans("", "", ",")  # strips thousands separators in one C-level pass
+
+_num_re   = re.compile(r"\d[\d,]*")  # must start with a digit, so a lone "," never reaches int()
 _float_re = re.compile(r"\d+(?:\.\d+)?")
 
+def _has_class(name: str) -> str:
+    """XPath predicate matching `name` as a whole token of @class."""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+# Precompiled XPaths; each row query takes only the first matching element.
+_XP_ROWS   = lxml.etree.XPath(f'//table[{_has_class("tableList")}]//tr')
+_XP_TITLE  = lxml.etree.XPath(f'(.//a[{_has_class("bookTitle")}])[1]//text()')
+_XP_AUTHOR = lxml.etree.XPath(f'(.//a[{_has_class("authorName")}])[1]//text()')
+_XP_MINI   = lxml.etree.XPath(f'(.//span[{_has_class("minirating")}])[1]//text()')
+_XP_SCORE  = lxml.etree.XPath('(.//a[contains(@onclick, "score_explanation")])[1]//text()')
+_XP_VOTED  = lxml.etree.XPath(
+    '(.//a[contains(translate(normalize-space(.), "PEOLVTD", "peolvtd"), "people voted")])[1]//text()'
+)
+
+def _join_text(parts: list[str], sep: str = "") -> str:
+    """Join XPath text nodes, dropping whitespace-only pieces (like get_text(strip=True))."""
+    return sep.join(t.strip() for t in parts if t.strip())
+
 def _to_int(s: str | None) -> int | None:
     """Extract the first integer-like number from a string (handles commas)."""
     if not s:
         return None
     m = _num_re.search(s)
-    return int(m.group(0).replace(",", "")) if m else None
+    return int(m.group(0).translate(_COMMA_TBL)) if m else None
+
+def _clamp_pg_int(n: int | None) -> int | None:
+    """Cap a value headed for an INTEGER column so an outlier can't fail the whole load."""
+    return None if n is None else min(n, _PG_INT_MAX)
 
 def _to_float(s: str | None) -> float | None:
     """Extract the first float-like number from a string."""
@@ -74,143 +136,228 @@ def _to_float(s: str | None) -> float | None:
     m = _float_re.search(s)
     return float(m.group(0)) if m else None
 
-def _parse_row(tr) -> dict:
+def _parse_row(tr) -> tuple:
     """
-    Parse a <tr> from Goodreads list table into:
-      {title, author, avg_rating, num_ratings, score, people_voted}
+    Parse a <tr> from Goodreads list table into a tuple in BOOK_COLUMNS order:
+      (title, author, avg_rating, num_ratings, score, people_voted)
     """
     # Title
-    title_el = tr.select_one("a.bookTitle span") or tr.select_one("a.bookTitle")
-    title = title_el.get_text(strip=True) if title_el else None
+    title = _join_text(_XP_TITLE(tr)) or None
 
     # Author
-    author_el = tr.select_one("a.authorName span") or tr.select_one("a.authorName")
-    author = author_el.get_text(strip=True) if author_el else None
+    author = _join_text(_XP_AUTHOR(tr)) or None
 
     # Avg rating & num ratings (e.g., "4.28 avg rating — 9,117,773 ratings")
-    mini = tr.select_one("span.minirating")
-    mini_text = mini.get_text(" ", strip=True) if mini else ""
+    mini_text = _join_text(_XP_MINI(tr), " ")
     avg_rating = _to_float(mini_text)
-    nums = [int(n.replace(",", "")) for n in _num_re.findall(mini_text)]
-    num_ratings = max(nums) if nums else None  # usually the largest number is 'ratings' count
+    # usually the largest number is 'ratings' count
+    it = (int(m.group(0).translate(_COMMA_TBL)) for m in _num_re.finditer(mini_text))
+    num_ratings = max(it, default=None)
 
     # Score anchor: <a onclick="Lightbox.showBoxByID('score_explanation', ...)">score: 2,947,818</a>
-    score = None
-    score_el = tr.select_one('a[onclick*="score_explanation"]')
-    if score_el:
-        score = _to_int(score_el.get_text(" ", strip=True))
+    score = _clamp_pg_int(_to_int(_join_text(_XP_SCORE(tr), " ")))
 
     # People voted anchor (e.g., "30,210 people voted")
-    people_voted = None
-    for a in tr.select("a"):
-        txt = a.get_text(" ", strip=True).lower()
-        if "people voted" in txt:
-            people_voted = _to_int(txt)
-            break
-
-    return {
-        "title": title,
-        "author": author,
-        "avg_rating": avg_rating,
-        "num_ratings": num_ratings,
-        "score": score,
-        "people_voted": people_voted,
-    }
+    people_voted = _clamp_pg_int(_to_int(_join_text(_XP_VOTED(tr), " ")))
+
+    return (title, author, avg_rating, num_ratings, score, people_voted)
 
 # ------------------------------ TASKS ----------------------------------------
 
-def fetch_goodreads_books(num_books: int = NUM_BOOKS, max_pages: int = MAX_PAGES, **context):
+def fetch_goodreads_books(num_books: int = NUM_BOOKS, max_pages: int = MAX_PAGES) -> list[tuple]:
     """
     Scrape Goodreads list pages until we gather `num_books` rows or hit `max_pages`.
-    Pushes XCom key='book_data' as list[dict].
-    Includes a mock fallback if nothing is parsed (dev convenience).
+    Returns rows as tuples in BOOK_COLUMNS order (empty if nothing could be parsed).
     """
-    ti = context["ti"]
-    session = requests.Session()
-    session.headers.update(HEADERS)
-
-    books, seen, page = [], set(), 1
-
-    try:
-        while len(books) < num_books and page <= max_pages:
-            # Polite random delay to avoid being throttled
-            time.sleep(random.uniform(*REQUEST_DELAY_SECS))
+    # Shared rate limiter: each worker reserves the next start slot, spaced by a random
+    # polite delay divided across the workers. `stop` wakes waiting workers once the crawl ends.
+    slot_lock = threading.Lock()
+    next_slot = [time.monotonic()]
+    stop = threading.Event()
+
+    books: dict[str, tuple] = {}  # title -> row; insertion-ordered, so it also de-dups
+    pages = range(1, max_pages + 1)
+
+    with requests.Session() as session:
+        session.headers.update(HEADERS)
+        session.headers["Connection"] = "keep-alive"
+
+        # Single-host crawl: one small keep-alive pool reused across every page. It starts with the
+        # single-attempt pre-warm policy and switches to _HTTP_RETRY before any worker starts.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_CONCURRENCY, max_retries=_PREWARM_RETRY)
+        session.mount("https://", adapter)
+
+        # Pre-warm the pool so DNS + TLS are done before the paced page fetches start
+        try:
+            session.head(LIST_URL, timeout=25)
+        except requests.RequestException as e:
+            print(f"[WARN] Connection pre-warm failed: {e!r}")
+        adapter.max_retries = _HTTP_RETRY
+
+        def fetch_page(page: int) -> tuple[int, list[tuple]]:
+            """Fetch and parse one list page. Returns (HTTP status, parsed rows); status 0 if skipped."""
+            with slot_lock:
+                now = time.monotonic()
+                start = max(next_slot[0], now)
+                next_slot[0] = start + random.uniform(*REQUEST_DELAY_SECS) / FETCH_CONCURRENCY
+            if stop.wait(max(start - now, 0)):
+                return 0, []
 
             resp = session.get(LIST_URL, params={"page": page}, timeout=25)
             if resp.status_code != 200:
-                print(f"[WARN] HTTP {resp.status_code} on page {page}, stopping.")
-                break
-
-            soup = BeautifulSoup(resp.text, "html.parser")
-            page_found = 0
-
-            for tr in soup.select("table.tableList tr"):
-                row = _parse_row(tr)
-                title = row.get("title")
-                if not title or title in seen:
-                    continue
-                seen.add(title)
-                books.append(row)
-                page_found += 1
-                if len(books) >= num_books:
+                return resp.status_code, []
+
+            # Hand raw bytes to lxml so decoding happens in C, without an intermediate str. Only force
+            # an encoding the server actually declared; requests' ISO-8859-1 default for bare text/html
+            # would override the page's <meta charset>.
+            declared = "charset=" in resp.headers.get("Content-Type", "").lower()
+            parser = lxml.html.HTMLParser(encoding=get_encoding_from_headers(resp.headers) if declared else None)
+            tree = lxml.html.document_fromstring(resp.content, parser=parser)
+            return resp.status_code, [_parse_row(tr) for tr in _XP_ROWS(tree)]
+
+        pool = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY)
+
+        try:
+            # map() yields in page order, so the stop conditions below behave as in a sequential crawl
+            for page, (status, rows) in zip(pages, pool.map(fetch_page, pages)):
+                if status != 200:
+                    print(f"[WARN] HTTP {status} on page {page}, stopping.")
                     break
 
-            print(f"[INFO] Page {page} parsed. New rows: {page_found}. Total: {len(books)}.")
-            if page_found == 0 and page > 1:
-                # if we reach a page with no rows after already collecting some, likely end or blocked
-                print("[INFO] No new rows found on this page; stopping early.")
-                break
-
-            page += 1
-    except Exception as e:
-        print(f"[ERROR] Exception during scraping: {e!r}")
-        # fall through to fallback
-
-    # Fallback — keeps pipeline testable if scraping yields nothing
-    if not books:
-        print("[WARN] No rows parsed; using mock fallback data.")
-        books = [
-            {"title": "Mock Book A", "author": "Jane Example", "avg_rating": 4.25, "num_ratings": 120_345, "score": 98_000, "people_voted": 45_000},
-            {"title": "Mock Book B", "author": "John Example", "avg_rating": 4.10, "num_ratings": 80_321, "score": 65_000, "people_voted": 30_000},
-        ][:num_books]
+                page_found = 0
+                for row in rows:
+                    title = row[0]
+                    if not title or title in books:
+                        continue
+                    books[title] = row
+                    page_found += 1
+                    if len(books) >= num_books:
+                        break
+
+                print(f"[INFO] Page {page} parsed. New rows: {page_found}. Total: {len(books)}.")
+                if len(books) >= num_books:
+                    break
+                if page_found == 0 and page > 1:
+                    # if we reach a page with no rows after already collecting some, likely end or blocked
+                    print("[INFO] No new rows found on this page; stopping early.")
+                    break
+        except Exception as e:
+            print(f"[ERROR] Exception during scraping: {e!r}")
+            # fall through to fallback
+        finally:
+            # Cancel queued pages, release workers waiting on the rate limiter, and wait for any
+            # request already in flight so nothing touches the session after it is closed.
+            stop.set()
+            pool.shutdown(wait=True, cancel_futures=True)
 
-    # De-dup by title & clip to desired count
-    df = pd.DataFrame(books).drop_duplicates(subset=["title"]).head(num_books)
-    ti.xcom_push(key="book_data", value=df.to_dict("records"))
-    print(f"[INFO] XCom pushed {len(df)} rows.")
+    # Rows are already de-duplicated by title while scraping; just clip to desired count
+    return list(books.values())[:num_books]
 
 
-def insert_goodreads_into_postgres(**context):
+def insert_goodreads_into_postgres(book_data: list[tuple]) -> int:
     """
-    Pull XCom 'book_data' and insert rows into Postgres table `goodreads_books`.
+    Ensure `goodreads_books` exists, COPY `book_data` into a temp table and upsert it keyed
+    on (title, author), all in one transaction. Returns the number of rows written.
     """
-    ti = context["ti"]
-    book_data = ti.xcom_pull(key="book_data", task_ids="fetch_goodreads")
     if not book_data:
         raise ValueError("No book data found")
 
-    hook = PostgresHook(postgres_conn_id=POSTGRES_CONN_ID)
-    insert_sql = """
-        INSERT INTO goodreads_books
-        (title, author, avg_rating, num_ratings, score, people_voted)
-        VALUES (%s, %s, %s, %s, %s, %s)
+    # Stage rows as in-memory CSV; None becomes an unquoted empty field, read back as NULL
+    buf = io.StringIO()
+    csv.writer(buf).writerows(book_data)
+    buf.seek(0)
+
+    # Idempotent DDL on the load connection, so the scrape never waits on a separate DDL task
+    ddl_sql = """
+        CREATE TABLE IF NOT EXISTS goodreads_books (
+            id SERIAL PRIMARY KEY,
+            title TEXT NOT NULL,
+            author TEXT,
+            avg_rating DOUBLE PRECISION,
+            num_ratings BIGINT,
+            score INTEGER,
+            people_voted INTEGER
+        );
+
+        -- One-off migration for tables created while these columns were BIGINT
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                  AND table_name = 'goodreads_books'
+                  AND column_name IN ('score', 'people_voted')
+                  AND data_type = 'bigint'
+            ) THEN
+                ALTER TABLE goodreads_books
+                    ALTER COLUMN score TYPE INTEGER USING LEAST(score, 2147483647)::INTEGER,
+                    ALTER COLUMN people_voted TYPE INTEGER USING LEAST(people_voted, 2147483647)::INTEGER;
+            END IF;
+        END $$;
+
+        -- Upsert key; an index (not a table constraint) so tables from earlier runs pick it up too.
+        -- NULLS NOT DISTINCT (Postgres 15+) so books without an author still conflict and update.
+        CREATE UNIQUE INDEX IF NOT EXISTS goodreads_books_title_author_key
+            ON goodreads_books (title, author) NULLS NOT DISTINCT;
+
+        CREATE INDEX IF NOT EXISTS idx_goodreads_score
+            ON goodreads_books (score DESC);
+    """
+    columns = ", ".join(BOOK_COLUMNS)
+    stage_sql = f"""
+        CREATE TEMP TABLE goodreads_books_stage ON COMMIT DROP AS
+        SELECT {columns} FROM goodreads_books WITH NO DATA
+    """
+    copy_sql = """
+        COPY goodreads_books_stage
+        FROM STDIN WITH (FORMAT CSV, NULL '')
     """
+    # Only touch rows whose stats actually changed, so steady-state runs write almost nothing
+    merge_sql = f"""
+        INSERT INTO goodreads_books ({columns})
+        SELECT {columns} FROM goodreads_books_stage
+        ON CONFLICT (title, author) DO UPDATE SET
+            avg_rating = EXCLUDED.avg_rating,
+            num_ratings = EXCLUDED.num_ratings,
+            score = EXCLUDED.score,
+            people_voted = EXCLUDED.people_voted
+        WHERE (goodreads_books.avg_rating, goodreads_books.num_ratings,
+               goodreads_books.score, goodreads_books.people_voted)
+          IS DISTINCT FROM
+              (EXCLUDED.avg_rating, EXCLUDED.num_ratings,
+               EXCLUDED.score, EXCLUDED.people_voted)
+    """
+    hook = PostgresHook(postgres_conn_id=POSTGRES_CONN_ID)
     with hook.get_conn() as conn:
         with conn.cursor() as cur:
-            for b in book_data:
-                cur.execute(
-                    insert_sql,
-                    (
-                        b.get("title"),
-                        b.get("author"),
-                        b.get("avg_rating"),
-                        b.get("num_ratings"),
-                        b.get("score"),
-                        b.get("people_voted"),
-                    ),
-                )
+            cur.execute(ddl_sql)
+            cur.execute(stage_sql)
+            cur.copy_expert(copy_sql, buf)
+            cur.execute(merge_sql)
+            upserted = cur.rowcount
         conn.commit()
-    print(f"[INFO] Inserted {len(book_data)} rows into Postgres.")
+    return upserted
+
+
+def fetch_and_store_goodreads_books(num_books: int = NUM_BOOKS, max_pages: int = MAX_PAGES, **context):
+    """
+    Scrape the list and load it into Postgres within one task, so rows never pass through XCom.
+    """
+    book_data = fetch_goodreads_books(num_books, max_pages)
+    if not book_data:
+        if not USE_MOCK_FALLBACK:
+            raise ValueError("No rows parsed (blocked or markup change?)")
+        # Dev convenience: keep the run green, but never persist fake books in the real table
+        mock = [
+            ("Mock Book A", "Jane Example", 4.25, 120_345, 98_000, 45_000),
+            ("Mock Book B", "John Example", 4.10, 80_321, 65_000, 30_000),
+        ][:num_books]
+        print(f"[WARN] No rows parsed; mock fallback data (not loaded): {mock}")
+        return
+
+    print(f"[INFO] Scraped {len(book_data)} rows.")
+    upserted = insert_goodreads_into_postgres(book_data)
+    print(f"[INFO] Inserted or updated {upserted} rows in Postgres.")
 
 
 # ------------------------------ DAG ------------------------------------------
@@ -232,39 +379,15 @@ with DAG(
     tags=["goodreads", "books"],
 ) as dag:
 
-
-    create_table_task = SQLExecuteQueryOperator(
-        task_id="create_goodreads_table",
-        conn_id=POSTGRES_CONN_ID,
-        sql="""
-        DROP TABLE IF EXISTS goodreads_books;
-
-        CREATE TABLE IF NOT EXISTS goodreads_books (
-            id SERIAL PRIMARY KEY,
-            title TEXT NOT NULL,
-            author TEXT,
-            avg_rating DOUBLE PRECISION,
-            num_ratings BIGINT,
-            score BIGINT,
-            people_voted BIGINT
-        );
-        """,
-    )
-
-    fetch_task = PythonOperator(
-        task_id="fetch_goodreads",
-        python_callable=fetch_goodreads_books,
+    fetch_and_store_task = PythonOperator(
+        task_id="fetch_and_store_goodreads",
+        python_callable=fetch_and_store_goodreads_books,
         op_kwargs={"num_books": NUM_BOOKS, "max_pages": MAX_PAGES},
         # Optional: longer timeout for 100 pages
         execution_timeout=timedelta(minutes=30),
+        do_xcom_push=False,
     )
 
-    insert_task = PythonOperator(
-        task_id="insert_goodreads",
-        python_callable=insert_goodreads_into_postgres,
-    )
-
-    fetch_task >> create_table_task >> insert_task
 
 # =============================================================================
 # End of DAG